@@ -1,22 +1,54 @@
 #! /bin/env python3
 
-import sys
-import json
+import os
 import subprocess
-from tempfile import TemporaryDirectory
-from collections import defaultdict
-from datetime import datetime, timedelta
+from tempfile import TemporaryDirectory, TemporaryFile
+from collections import Counter, OrderedDict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from hashlib import sha256
 from pathlib import Path
-from shutil import rmtree
-from subprocess import PIPE, CompletedProcess
-from zipfile import ZIP_DEFLATED, ZipFile
+from shutil import copyfile, rmtree
+
+try:
+    # orjson is considerably faster than the standard library for the large reports generated by JPlag
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    import json
+    from json import loads as json_loads
+
+    def json_dumps(obj: object) -> bytes:
+        return json.dumps(obj).encode()
 
 from exception import PyPlagException
 from report import PyPlagReport
 from settings import PyPlagSettings
-from submission import PyPlagSubmission
+from submission import PyPlagDiskFiles, PyPlagSubmission
 
 class PyPlag:
+    SUPPORTED_LANGUAGES: frozenset[str] = frozenset({
+        "c",
+        "cpp",
+        "csharp",
+        "emf",
+        "emf-model",
+        "go",
+        "java",
+        "javascript",
+        "kotlin",
+        "llvmir",
+        "multi",
+        "python3",
+        "rlang",
+        "rust",
+        "scala",
+        "scheme",
+        "scxml",
+        "swift",
+        "text",
+        "typescript",
+    })
+
     def __init__(
         self,
         settings: PyPlagSettings,
@@ -26,31 +58,10 @@ class PyPlag:
         if self.settings.report_dir.exists():
             rmtree(self.settings.report_dir)
 
-        self.supported_languages: list[str] = [
-            "c",
-            "cpp",
-            "csharp",
-            "emf",
-            "emf-model",
-            "go",
-            "java",
-            "javascript",
-            "kotlin",
-            "llvmir",
-            "multi",
-            "python3",
-            "rlang",
-            "rust",
-            "scala",
-            "scheme",
-            "scxml",
-            "swift",
-            "text",
-            "typescript",
-        ]
+        self._staged_submissions: OrderedDict[tuple, TemporaryDirectory] = OrderedDict()
 
     def run(self, lang: str, submissions: list[PyPlagSubmission]) -> PyPlagReport:
-        if lang not in self.supported_languages:
+        if lang not in self.SUPPORTED_LANGUAGES:
             if not self.settings.ignore_unsupported_language:
                 raise PyPlagException(f"Attempted to run JPlag on submissions in unsupported language '{lang}'")
 
@@ -59,166 +70,330 @@ class PyPlag:
         if len(submissions) <= 1:
             raise PyPlagException("Too few submissions")
 
-        with TemporaryDirectory(prefix="pyplag-subs-") as tmpfile_path:
-            submissions_dir: Path = Path(tmpfile_path)
-            for submission in submissions:
-                (submissions_dir / submission.id).mkdir(parents=True)
+        if self.settings.max_staged_submissions > 0:
+            return self._run_jplag(lang, submissions, self.stage_submissions(submissions))
 
-                for filename, file_content in submission.files.items():
-                    with open(submissions_dir / submission.id / filename, "w") as file:
-                        file.write(file_content)
+        # Without reuse, the submissions are removed again as soon as JPlag is done with them
+        with self._write_submissions(submissions, _submission_digests(submissions)) as submissions_dir:
+            return self._run_jplag(lang, submissions, Path(submissions_dir))
 
-            extra_args: list[str] = []
-            if not self.settings.clustering:
-                extra_args.append("--cluster-skip")
+    def _run_jplag(self, lang: str, submissions: list[PyPlagSubmission], submissions_dir: Path) -> PyPlagReport:
+        jvm_args: list[str] = []
+        if self.settings.jvm_cds_archive is not None:
+            # Requires JDK 19 or newer, which JPlag already does
+            jvm_args.append("-XX:+AutoCreateSharedArchive")
+            jvm_args.append(f"-XX:SharedArchiveFile={self.settings.jvm_cds_archive}")
 
-            self.settings.report_dir.mkdir(exist_ok=True, parents=True)
-            report: Path = self.settings.report_dir / f"{lang}.jplag"
+        extra_args: list[str] = []
+        if not self.settings.clustering:
+            extra_args.append("--cluster-skip")
 
+        self.settings.report_dir.mkdir(exist_ok=True, parents=True)
+        report: Path = self.settings.report_dir / f"{lang}.jplag"
+
+        argv: list[str] = [
+            str(self.settings.java_cmd),
+            *jvm_args,
+            "-jar",
+            str(self.settings.jplag_jar),
+            "-l",
+            lang,
+            "-M",
+            "RUN",
+            "-r",
+            str(report),
+            *extra_args,
+            str(submissions_dir),
+        ]
+
+        # JPlag's output is sent to temporary files rather than pipes, so that it's buffered by the kernel
+        # instead of in memory, and decoded in one go once JPlag has finished.
+        with TemporaryFile() as stdout_file, TemporaryFile() as stderr_file:
             result = subprocess.run(
-                [
-                    self.settings.java_cmd,
-                    "-jar",
-                    self.settings.jplag_jar,
-                    "-l",
-                    lang,
-                    "-M",
-                    "RUN",
-                    "-r",
-                    report,
-                    *extra_args,
-                    submissions_dir,
-                ],
-                stdout=PIPE,
-                stderr=PIPE,
-                text=True,
+                argv,
+                stdout=stdout_file,
+                stderr=stderr_file,
             )
 
-            report_min: Path | None = None
+            stdout_file.seek(0)
+            stdout: str = stdout_file.read().decode("utf-8", "replace")
+            stderr_file.seek(0)
+            stderr: str = stderr_file.read().decode("utf-8", "replace")
 
-            if result.returncode == 0:
-                if self.settings.filter_runs_by_author:
-                    report, report_min = self._post_process_jplag_results(report, submissions)
+        report_min: Path | None = None
 
-            return PyPlagReport(
-                status=result.returncode,
-                stdout=result.stdout,
-                stderr=result.stderr,
-                report_path=report,
-                report_min_path=report_min,
-            )
+        if result.returncode == 0:
+            if self.settings.filter_runs_by_author:
+                report, report_min = self._post_process_jplag_results(report, submissions)
+
+        return PyPlagReport(
+            status=result.returncode,
+            stdout=stdout,
+            stderr=stderr,
+            report_path=report,
+            report_min_path=report_min,
+        )
+
+    def stage_submissions(self, submissions: list[PyPlagSubmission]) -> Path:
+        """
+        Write the submissions to a temporary directory for JPlag to read, and return its path.
+
+        Staged submissions are kept until the PyPlag object is closed, and are reused when staging identical
+        submissions again, e.g. when running JPlag on the same submissions for several languages. Up to
+        max_staged_submissions sets of submissions are kept, but always at least the one just staged.
+        """
+        digests: dict[str, dict[str, bytes]] = _submission_digests(submissions)
+
+        # Files held in memory are identified by their content digest; files on disk by their path, modification time
+        # and size, so that files edited in between runs are staged again.
+        key_parts: list[tuple[str, frozenset[tuple]]] = []
+        for submission in submissions:
+            if isinstance(submission.files, PyPlagDiskFiles):
+                file_keys: list[tuple[str, str, int, int]] = []
+                for filename, source_path in submission.files.paths.items():
+                    stat: os.stat_result = os.stat(source_path)
+                    file_keys.append((filename, os.fspath(source_path), stat.st_mtime_ns, stat.st_size))
+                files_key = frozenset(file_keys)
+            else:
+                files_key = frozenset(digests[submission.id].items())
+            key_parts.append((submission.id, files_key))
+        key: tuple = tuple(key_parts)
+
+        if key in self._staged_submissions:
+            self._staged_submissions.move_to_end(key)
+            return Path(self._staged_submissions[key].name)
+
+        # Only cache the staged submissions once they've been written out completely
+        staging_dir: TemporaryDirectory = self._write_submissions(submissions, digests)
+        self._staged_submissions[key] = staging_dir
+        while len(self._staged_submissions) > max(self.settings.max_staged_submissions, 1):
+            _, evicted_dir = self._staged_submissions.popitem(last=False)
+            evicted_dir.cleanup()
+
+        return Path(staging_dir.name)
+
+    def _write_submissions(
+        self,
+        submissions: list[PyPlagSubmission],
+        digests: dict[str, dict[str, bytes]],
+    ) -> TemporaryDirectory:
+        """
+        Write the submissions to a new temporary directory, which is removed again if any of them can't be written.
+        """
+        staging_dir: TemporaryDirectory = TemporaryDirectory(
+            prefix="pyplag-subs-",
+            dir=self.settings.submissions_tmp_dir,
+        )
+        submissions_dir: Path = Path(staging_dir.name)
+
+        # Submissions often share files (e.g. starter code), so identical files are hardlinked to the first copy
+        # written, rather than written out again.
+        written_files: dict[bytes, str] = {}
+
+        try:
+            for submission in submissions:
+                (submissions_dir / submission.id).mkdir(parents=True)
+
+                if isinstance(submission.files, PyPlagDiskFiles):
+                    # Copy files on disk directly, which lets the OS avoid reading them into memory at all
+                    for filename, source_path in submission.files.paths.items():
+                        copyfile(source_path, os.path.join(submissions_dir, submission.id, filename))
+                    continue
+
+                for filename, file_content in submission.files.items():
+                    file_path: str = os.path.join(submissions_dir, submission.id, filename)
+
+                    digest: bytes = digests[submission.id][filename]
+                    if digest in written_files:
+                        try:
+                            os.link(written_files[digest], file_path)
+                            continue
+                        except OSError:
+                            # Not all file systems support hardlinks; fall back to writing the file
+                            pass
+
+                    _write_file(file_path, _encode(file_content))
+                    written_files.setdefault(digest, file_path)
+        except BaseException:
+            staging_dir.cleanup()
+            raise
+
+        return staging_dir
+
+    def close(self) -> None:
+        """
+        Remove all staged submissions.
+        """
+        for staging_dir in self._staged_submissions.values():
+            staging_dir.cleanup()
+        self._staged_submissions.clear()
+
+    def __enter__(self) -> "PyPlag":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
 
     def _post_process_jplag_results(self, report: Path, submissions: list[PyPlagSubmission]) -> None:
         """
         This is an experimental feature to exclude plagiarism reports from submissions made by the same author.
         """
-        submissions_dict: dict[str, PyPlagSubmission] = {
-            submission.id: submission for submission in submissions
+        # Only imported here, as the post-processing is optional
+        from zipfile import ZIP_DEFLATED, ZipFile
+
+        id_to_author: dict[str, str] = {
+            submission.id: submission.author for submission in submissions
         }
 
         report_min: Path = report.with_stem(f"{report.stem}.min")
 
-        with TemporaryDirectory(prefix="pyplag-") as tmpfile_path:
-            tmpfile: Path = Path(tmpfile_path)
+        ignore_files: frozenset[str] = frozenset({
+            "basecode",
+            "files",
+            "options.json",
+            "overview.json",
+            "README.txt",
+            "submissionFileIndex.json",
+        })
+
+        # The report is streamed member-by-member from the original .jplag file into the new one,
+        # rather than extracting the whole report to disk and zipping it back up afterwards.
+        # It's written to a temporary file first, so that report_min is never left incomplete.
+        # We need to use ZIP_DEFLATED to generate zip v2.0 files, for JPlag compatability.
+        with (
+            _replace_on_success(report_min) as report_min_tmp,
+            ZipFile(report) as zip_file,
+            ZipFile(
+                report_min_tmp,
+                "w",
+                compression=ZIP_DEFLATED,
+                compresslevel=self.settings.report_compresslevel,
+            ) as zip_file_min,
+        ):
+            overview: dict = json_loads(zip_file.read("overview.json"))
+
+            # Constant defined in JPlag
+            SIMILARITY_DISTRIBUTION_SIZE = 100
+            # Number of removed comparisons per bucket of the MAX and AVG distributions.
+            # We can't correct the MIN and INTERSECTION metrics, as they're missing from the comparison-files,
+            # but they appear to be unused.
+            removed_distributions: dict[str, Counter[int]] = {
+                "MAX": Counter(),
+                "AVG": Counter(),
+            }
+            removed_pairs: set[frozenset[str]] = set()
+
+            for info in zip_file.infolist():
+                if info.is_dir() or info.filename == "overview.json":
+                    continue
 
-            with ZipFile(report) as zip_file:
-                zip_file.extractall(tmpfile)
+                data: bytes = zip_file.read(info)
 
-            overview: dict
-            with open(tmpfile / "overview.json") as file:
-                overview = json.load(file)
+                # We only want to loop through the .json files for the pair-wise comparisons; copy other files
+                if "/" in info.filename or info.filename in ignore_files:
+                    zip_file_min.writestr(info.filename, data)
+                    continue
 
-            ignore_files: list[str] = [
-                "basecode",
-                "files",
-                "options.json",
-                "overview.json",
-                "README.txt",
-                "submissionFileIndex.json",
-            ]
-            for file_path in tmpfile.iterdir():
-                # We only want to loop through the .json files for the pair-wise comparisons; skip other files
-                if file_path.name in ignore_files:
+                # Only comparisons between submissions by the same author need to be read
+                submission_id1, submission_id2 = info.filename.rpartition(".json")[0].split("-", 1)
+                if id_to_author[submission_id1] != id_to_author[submission_id2]:
+                    zip_file_min.writestr(info.filename, data)
                     continue
 
-                submission_id1, submission_id2 = file_path.stem.split("-")
-                submission1: PyPlagSubmission = submissions_dict[submission_id1]
-                submission2: PyPlagSubmission = submissions_dict[submission_id2]
-
-                if submission1.author == submission2.author:
-                    file_data: dict
-                    with open(file_path, "r+") as file:
-                        file_data = json.load(file)
-                        file.write(
-                            json.dumps(
-                                {
-                                    "id1": submission_id1,
-                                    "id2": submission_id2,
-                                    "similarities": {
-                                        "MAX": 0.0,
-                                        "AVG": 0.0,
-                                    },
-                                    "matches": [],
-                                    "first_similarity": 0.0,
-                                    "second_similarity": 0.0,
-                                }
-                            )
+                similarities: dict[str, float] = _read_similarities(data)
+                removed_pairs.add(frozenset((submission_id1, submission_id2)))
+
+                for metric, removed_distribution in removed_distributions.items():
+                    # This should behave simlarly to calculateDistributionFor in JPlagResult.java
+                    removed_distribution[
+                        min(
+                            int(similarities[metric] * SIMILARITY_DISTRIBUTION_SIZE),
+                            SIMILARITY_DISTRIBUTION_SIZE - 1,
                         )
-                    file_path.unlink()
-
-                    try:
-                        del overview["submission_ids_to_comparison_file_name"][submission_id1][submission_id2]
-                        del overview["submission_ids_to_comparison_file_name"][submission_id2][submission_id1]
-                        pass
-                    except KeyError:
-                        pass
-
-                    # Constant defined in JPlag
-                    SIMILARITY_DISTRIBUTION_SIZE = 100
-                    # Correct the MAX and AVG metrics; we can't correct the MIN and INTERSECTION metrics,
-                    # as they're missing from the comparison-files, but they appear to be unused.
-                    for metric in ["MAX", "AVG"]:
-                        # This should behave simlarly to calculateDistributionFor in JPlagResult.java
-                        overview["distributions"][metric][
-                            min(
-                                int(file_data["similarities"][metric] * SIMILARITY_DISTRIBUTION_SIZE),
-                                SIMILARITY_DISTRIBUTION_SIZE - 1,
-                            )
-                        ] -= 1
-
-                    def filter_comparison(comp: dict) -> bool:
-                        if (comp["first_submission"] == submission_id1 and comp["second_submission"] == submission_id2) or (
-                            comp["first_submission"] == submission_id2 and comp["second_submission"] == submission_id1
-                        ):
-                            return False
-
-                        return True
-
-                    overview["top_comparisons"] = list(filter(filter_comparison, overview["top_comparisons"]))
+                    ] += 1
 
                 # TODO: Parse the remaining files to see if JPlag has detected any plagiarisms
                 # and compile a report of the offending submissions.
 
-            with open(tmpfile / "overview.json", "w") as file:
-                file.write(json.dumps(overview))
+            # Correct the MAX and AVG metrics in one go, rather than once per removed comparison
+            for metric, removed_distribution in removed_distributions.items():
+                distribution: list[int] = overview["distributions"][metric]
+                for bucket, count in removed_distribution.items():
+                    distribution[bucket] -= count
+
+            for submission_id1, submission_id2 in removed_pairs:
+                try:
+                    del overview["submission_ids_to_comparison_file_name"][submission_id1][submission_id2]
+                    del overview["submission_ids_to_comparison_file_name"][submission_id2][submission_id1]
+                    pass
+                except KeyError:
+                    pass
+
+            overview["top_comparisons"] = [
+                comp for comp in overview["top_comparisons"]
+                if frozenset((comp["first_submission"], comp["second_submission"])) not in removed_pairs
+            ]
 
-            # Zip the results, overwriting the original .jplag report.
-            # We need to use ZIP_DEFLATED to generate zip v2.0 files, for JPlag compatability.
-            with ZipFile(report_min, "w", compression=ZIP_DEFLATED) as zip_file:
-                for current_path, subfolders, filenames in tmpfile.walk():
-                    for filename in filenames:
-                        file_path = current_path / filename
-                        arcname = file_path.relative_to(tmpfile)
-                        zip_file.write(file_path, arcname)
+            zip_file_min.writestr("overview.json", json_dumps(overview))
 
         return report, report_min
 
-def main() -> None:
-    pyplag: PyPlag = PyPlag(PyPlagSettings(
-        java_cmd="/usr/lib/jvm/java-21-openjdk/bin/java",
-        filter_runs_by_author=True,
-    ))
+@contextmanager
+def _replace_on_success(path: Path) -> Iterator[Path]:
+    """
+    Yield a temporary path next to path, which atomically replaces path if the block completes successfully.
+    """
+    tmp_path: Path = path.with_name(f"{path.name}.tmp")
+    try:
+        yield tmp_path
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    os.replace(tmp_path, path)
 
+def _submission_digests(submissions: list[PyPlagSubmission]) -> dict[str, dict[str, bytes]]:
+    """
+    Compute the content digest of each file of the submissions held in memory, keyed by submission id and filename.
+    """
+    return {
+        submission.id: {
+            filename: sha256(_encode(file_content)).digest()
+            for filename, file_content in submission.files.items()
+        }
+        for submission in submissions
+        if not isinstance(submission.files, PyPlagDiskFiles)
+    }
+
+def _encode(file_content: str | bytes) -> bytes:
+    if isinstance(file_content, str):
+        return file_content.encode()
+    return file_content
+
+def _write_file(path: str, content: bytes) -> None:
+    """
+    Write content to a new file at path using raw file descriptors, bypassing Python's buffered text I/O.
+    """
+    fd: int = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        view: memoryview = memoryview(content)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def _read_similarities(data: bytes) -> dict[str, float]:
+    """
+    Read the MAX and AVG similarities from a pair-wise comparison file in a JPlag report.
+    """
+    file_data: dict = json_loads(data)
+
+    return {
+        "MAX": file_data["similarities"]["MAX"],
+        "AVG": file_data["similarities"]["AVG"],
+    }
+
+def main() -> None:
     file = """
         def main() -> None:
             message: str = f"Hello, {input()}"
@@ -230,10 +405,14 @@ def main() -> None:
             main()
     """
 
-    print(pyplag.run('python3', [
-        PyPlagSubmission("one", "t1", "python3", { "main.py": file }),
-        PyPlagSubmission("two", "t1", "python3", { "main.py": file }),
-    ]))
+    with PyPlag(PyPlagSettings(
+        java_cmd="/usr/lib/jvm/java-21-openjdk/bin/java",
+        filter_runs_by_author=True,
+    )) as pyplag:
+        print(pyplag.run('python3', [
+            PyPlagSubmission("one", "t1", "python3", { "main.py": file }),
+            PyPlagSubmission("two", "t1", "python3", { "main.py": file }),
+        ]))
 
 if __name__ == "__main__":
     main()
@@ -5,9 +5,21 @@ from pathlib import Path
 class PyPlagSettings:
     java_cmd: str = "java"
     jplag_jar: Path = Path("./dependencies/jplag.jar")
+    # Class data sharing archive for the JVM, e.g. Path("./dependencies/jplag.jsa"); it's created on the first run
+    # and reused afterwards, which cuts the JVM startup time of every later run. Disabled by default.
+    jvm_cds_archive: Path | None = None
 
     report_dir: Path = Path("./reports")
+    # Where the submissions are staged for JPlag; defaults to the system's temporary directory. On Linux, this can be
+    # set to a tmpfs such as /dev/shm so they're never written to disk, if it's large enough to hold them.
+    submissions_tmp_dir: Path | None = None
+    # Number of staged submission sets kept around for reuse by later runs, until the PyPlag object is closed.
+    # By default, the submissions are removed at the end of every run instead.
+    max_staged_submissions: int = 0
 
     clustering: bool = True
     filter_runs_by_author: bool = False
+    # Deflate level for the post-processed report; the comparison files are highly redundant JSON,
+    # so the fastest level compresses nearly as well as the default.
+    report_compresslevel: int = 1
     ignore_unsupported_language: bool = False
@@ -1,8 +1,26 @@
+from collections.abc import Iterator, Mapping
 from dataclasses import dataclass
+from pathlib import Path
+
+@dataclass(frozen=True)
+class PyPlagDiskFiles(Mapping[str, bytes]):
+    """
+    Submission files that are read lazily from disk, rather than held in memory; maps each filename to its path.
+    """
+    paths: Mapping[str, Path]
+
+    def __getitem__(self, filename: str) -> bytes:
+        return Path(self.paths[filename]).read_bytes()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.paths)
+
+    def __len__(self) -> int:
+        return len(self.paths)
 
 @dataclass(frozen=True)
 class PyPlagSubmission:
     id: str
     lang: str
     author: str
-    files: dict[str, str]
+    files: Mapping[str, str | bytes]